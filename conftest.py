@@ -0,0 +1 @@
+# Keeps the repo root importable (gmail_groq_worker) for tests under tests/ with plain `pytest`.
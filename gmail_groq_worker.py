@@ -1,21 +1,98 @@
-import os, base64, json, re, time
-from typing import Dict, Any, List, Tuple
+import asyncio, os, binascii, json, re, sqlite3, threading, time
+from email.utils import parseaddr
+from typing import Awaitable, Callable, Dict, Any, FrozenSet, List, Optional, Set, Tuple
 
-from groq import Groq
+import httplib2
+from groq import AsyncGroq
+from selectolax.parser import HTMLParser
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.model import JsonModel
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+
+try:
+    import orjson
+
+    def json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+    json_loads = orjson.loads
+except ImportError:  # fall back to the stdlib
+    json_dumps = json.dumps
+    json_loads = json.loads
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.modify"]
 INTERNAL_PROCESSED_LABEL = "AI/Processed"
 AI_IMPORTANT_LABEL = "AI/Important"
 MAX_RESULTS = 100
+BATCH_SIZE = 50  # Gmail's recommended max per batch request
 BODY_CHAR_LIMIT = 8000  # keep tokens/cost small
+METADATA_HEADERS = ["Subject", "From", "To", "Cc"]
+METADATA_MIN_CHARS = 180  # snippet (<= ~200 chars) + subject below this: fetch the full body
+MODIFY_BATCH_SIZE = 1000  # batchModify accepts up to 1000 ids per call
+GROQ_CONCURRENCY = 16  # in-flight Groq classification requests
+FILTERS_FILE = "filters.json"
+STATE_DB = "processed.db"  # local record of processed message ids
+SEEN_RETENTION_SECS = 7 * 24 * 3600  # also the maximum lookback window
+POLL_OVERLAP_SECS = 15 * 60  # re-scan this much before the last completed poll
+LLM_BATCH_SIZE = 10  # emails per Groq request; bounded by BODY_CHAR_LIMIT and model context
+LLM_MAX_WAIT = 0.5  # seconds to wait for a Groq batch to fill before sending it
+
+PUBSUB_TOPIC = os.getenv("GMAIL_PUBSUB_TOPIC")  # e.g. projects/my-project/topics/gmail-push
+PUBSUB_TOKEN = os.getenv("PUBSUB_VERIFICATION_TOKEN")  # expected ?token= on push requests
+PUSH_PATH = "/gmail/push"
+PUSH_FALLBACK_POLL_SECS = 3600  # safety-net poll when no push arrives
+WATCH_RENEW_SECS = 24 * 3600  # watches expire after 7 days; Google recommends renewing daily
+WATCH_RETRY_SECS = 60  # first retry delay after a failed watch, doubled up to hourly
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+GMAIL_MAX_ATTEMPTS = 5
 
 GROQ_MODEL = "moonshotai/kimi-k2-instruct"  # Fast and effective Groq model
 
+class FastJsonModel(JsonModel):
+    """googleapiclient JSON model that parses responses with orjson when available."""
+
+    def deserialize(self, content):
+        try:
+            body = json_loads(content)
+        except ValueError:
+            # Empty or non-JSON bodies are passed through, as JsonModel does
+            return content.decode("utf-8") if isinstance(content, bytes) else content
+        if self._data_wrapper and "data" in body:
+            body = body["data"]
+        return body
+
+def _is_retryable(exc: BaseException) -> bool:
+    return isinstance(exc, HttpError) and exc.resp.status in RETRYABLE_STATUSES
+
+_backoff = wait_exponential_jitter(initial=1, max=30)
+
+def _wait_retry_after(retry_state) -> float:
+    # Honor Gmail's Retry-After (seconds) when it sends one, else back off exponentially
+    exc = retry_state.outcome.exception()
+    retry_after = exc.resp.get("retry-after", "") if isinstance(exc, HttpError) else ""
+    if retry_after.isdigit():
+        return float(retry_after)
+    return _backoff(retry_state)
+
+gmail_retry = retry(
+    retry=retry_if_exception(_is_retryable),
+    wait=_wait_retry_after,
+    stop=stop_after_attempt(GMAIL_MAX_ATTEMPTS),
+    reraise=True,
+)
+
+# Built once so continuous mode reuses the same keep-alive connection
+_GMAIL_SERVICE = None
+
 def gmail_client():
+    global _GMAIL_SERVICE
+    if _GMAIL_SERVICE is not None:
+        return _GMAIL_SERVICE
     creds = None
     if os.path.exists("token.json"):
         creds = Credentials.from_authorized_user_file("token.json", SCOPES)
@@ -43,55 +120,206 @@ def gmail_client():
         # Save refreshed credentials
         with open("token.json", "w") as token:
             token.write(creds.to_json())
-    return build("gmail", "v1", credentials=creds)
+    http = AuthorizedHttp(creds, http=httplib2.Http(timeout=30))
+    _GMAIL_SERVICE = build("gmail", "v1", http=http, cache_discovery=False, model=FastJsonModel())
+    return _GMAIL_SERVICE
+
+# Label name -> id, filled by one labels().list call and reused across runs
+_LABEL_CACHE: Dict[str, str] = {}
+
+@gmail_retry
+def _load_labels(service):
+    res = service.users().labels().list(userId="me", fields="labels(id,name)").execute()
+    _LABEL_CACHE.clear()
+    for l in res.get("labels", []):
+        _LABEL_CACHE[l["name"]] = l["id"]
 
 def ensure_label(service, name: str) -> str:
-    labels = service.users().labels().list(userId="me").execute().get("labels", [])
-    for l in labels:
-        if l["name"] == name:
-            return l["id"]
-    new_label = service.users().labels().create(
-        userId="me", body={"name": name, "labelListVisibility": "labelShow", "messageListVisibility": "show"}
-    ).execute()
+    # Only the list is retried; create isn't idempotent, so a retry could hit "label exists"
+    if not _LABEL_CACHE:
+        _load_labels(service)
+    if name in _LABEL_CACHE:
+        return _LABEL_CACHE[name]
+    try:
+        new_label = service.users().labels().create(
+            userId="me", body={"name": name, "labelListVisibility": "labelShow", "messageListVisibility": "show"},
+            fields="id",
+        ).execute()
+    except HttpError as e:
+        if e.resp.status != 409:
+            raise
+        # Created concurrently or by an earlier attempt whose response was lost
+        _load_labels(service)
+        return _LABEL_CACHE[name]
+    _LABEL_CACHE[name] = new_label["id"]
     return new_label["id"]
 
-def get_unprocessed_message_ids(service, processed_label_id: str) -> List[str]:
-    # Get recent emails not yet processed, excluding trash and already marked spam
-    q = f"-label:{INTERNAL_PROCESSED_LABEL} -in:trash -in:spam newer_than:7d"
-    res = service.users().messages().list(userId="me", q=q, maxResults=MAX_RESULTS).execute()
-    return [m["id"] for m in res.get("messages", [])]
+_STATE_CONN: Optional[sqlite3.Connection] = None
+
+def state_db() -> sqlite3.Connection:
+    global _STATE_CONN
+    if _STATE_CONN is None:
+        _STATE_CONN = sqlite3.connect(STATE_DB)
+        _STATE_CONN.execute("CREATE TABLE IF NOT EXISTS seen(mid TEXT PRIMARY KEY, ts INTEGER)")
+        _STATE_CONN.execute("CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value INTEGER)")
+    # Drop ids older than the lookback window; Gmail will never list them again
+    _STATE_CONN.execute("DELETE FROM seen WHERE ts < ?", (int(time.time()) - SEEN_RETENTION_SECS,))
+    _STATE_CONN.commit()
+    return _STATE_CONN
+
+def mark_seen(conn: sqlite3.Connection, ids: List[str]):
+    now = int(time.time())
+    conn.executemany("INSERT OR IGNORE INTO seen(mid, ts) VALUES (?, ?)", [(mid, now) for mid in ids])
+    conn.commit()
+
+def mark_polled(conn: sqlite3.Connection, ts: int):
+    conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('last_poll', ?)", (ts,))
+    conn.commit()
+
+@gmail_retry
+def get_unprocessed_message_ids(service, conn: sqlite3.Connection) -> Tuple[List[str], bool]:
+    """Return ids not yet processed, and whether the listing covered the whole window."""
+    # Only scan back to shortly before the last completed poll (at most 7 days)
+    now = int(time.time())
+    row = conn.execute("SELECT value FROM meta WHERE key = 'last_poll'").fetchone()
+    since = max(row[0] - POLL_OVERLAP_SECS if row else 0, now - SEEN_RETENTION_SECS)
+    # The label clause still excludes processed mail when the local db is new or lost
+    q = f"-label:{INTERNAL_PROCESSED_LABEL} -in:trash -in:spam after:{since}"
+    res = service.users().messages().list(
+        userId="me", q=q, maxResults=MAX_RESULTS, fields="messages/id,nextPageToken"
+    ).execute()
+    ids = [m["id"] for m in res.get("messages", [])]
+    return filter_unseen(conn, ids), "nextPageToken" not in res
+
+def filter_unseen(conn: sqlite3.Connection, ids: List[str]) -> List[str]:
+    if not ids:
+        return []
+    placeholders = ",".join("?" * len(ids))
+    seen = {r[0] for r in conn.execute(f"SELECT mid FROM seen WHERE mid IN ({placeholders})", ids)}
+    return [mid for mid in ids if mid not in seen]
+
+@gmail_retry
+def start_watch(service, topic: str) -> str:
+    """Register (or renew) Gmail push notifications for INBOX; returns the current historyId."""
+    body = {"topicName": topic, "labelIds": ["INBOX"], "labelFilterBehavior": "include"}
+    return str(service.users().watch(userId="me", body=body).execute()["historyId"])
+
+@gmail_retry
+def get_history_message_ids(service, start_history_id: str) -> Tuple[Optional[List[str]], str]:
+    """Return ids added to INBOX since start_history_id, and the historyId to resume from.
+
+    The ids are None when Gmail no longer has history that far back and a full poll is needed.
+    """
+    ids: List[str] = []
+    history_id = start_history_id
+    page_token = None
+    while True:
+        try:
+            res = service.users().history().list(
+                userId="me", startHistoryId=start_history_id, historyTypes=["messageAdded"], labelId="INBOX",
+                pageToken=page_token, fields="history(messagesAdded/message/id),historyId,nextPageToken",
+            ).execute()
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            profile = service.users().getProfile(userId="me", fields="historyId").execute()
+            return None, str(profile["historyId"])
+        for h in res.get("history", []):
+            for added in h.get("messagesAdded", []):
+                mid = added["message"]["id"]
+                if mid not in ids:
+                    ids.append(mid)
+        history_id = str(res.get("historyId", history_id))
+        page_token = res.get("nextPageToken")
+        if not page_token:
+            return ids, history_id
+
+# Gmail returns URL-safe base64; translate to the standard alphabet and decode in C
+_URL_TO_STD = str.maketrans("-_", "+/")
 
 def _decode_part(b64: str) -> str:
-    return base64.urlsafe_b64decode(b64.encode("UTF-8")).decode(errors="ignore")
+    return binascii.a2b_base64(b64.translate(_URL_TO_STD).encode("ascii", "ignore")).decode(errors="ignore")
 
-def _collect_text(payload: Dict[str, Any]) -> str:
-    # Walk parts, prefer text/plain, fallback to html->text
-    def walk(p) -> Tuple[str, str]:
+def _html_to_text(html: str) -> str:
+    tree = HTMLParser(html)
+    tree.strip_tags(["script", "style"])
+    return tree.text(separator=" ", strip=True)
+
+def _collect_text(payload: Dict[str, Any], limit: int = BODY_CHAR_LIMIT) -> str:
+    # Walk parts depth-first in document order, prefer text/plain, fallback to html->text.
+    # Only about `limit` chars are kept, so parts are truncated while still base64 (4 chars ~ 3 bytes)
+    stack = [payload]
+    txts, htmls = [], []
+    txt_len = html_len = 0
+    while stack and txt_len < limit:
+        p = stack.pop()
         mime = p.get("mimeType", "")
-        bd = p.get("body", {})
-        data = bd.get("data")
+        data = p.get("body", {}).get("data")
         if data and mime == "text/plain":
-            return (_decode_part(data), "")
-        if data and mime == "text/html":
-            html = _decode_part(data)
-            text = re.sub(r"<[^>]+>", " ", html)
-            text = re.sub(r"\s+", " ", text).strip()
-            return ("", text)
-        parts = p.get("parts", [])
-        txts, htmls = [], []
-        for child in parts:
-            t, h = walk(child)
-            if t: txts.append(t)
-            if h: htmls.append(h)
-        return ("\n".join(txts), "\n".join(htmls))
-
-    t, h = walk(payload)
+            # 4 base64 chars per remaining char covers up to 3 UTF-8 bytes each
+            t = _decode_part(data[:(limit - txt_len) * 4])
+            if t:
+                txts.append(t)
+                txt_len += len(t)
+        elif data and mime == "text/html" and html_len < limit:
+            # Markup outweighs text; ~6 bytes of HTML per char of text kept
+            h = _html_to_text(_decode_part(data[:limit * 8]))[:limit - html_len]
+            if h:
+                htmls.append(h)
+                html_len += len(h)
+        stack.extend(reversed(p.get("parts", [])))
+
+    t = "\n".join(txts)
     if t.strip():
         return t
-    return h
+    return "\n".join(htmls)
+
+def fetch_messages_batch(service, ids: List[str], **get_kwargs) -> Dict[str, Dict[str, Any]]:
+    """Fetch messages via Gmail batch requests, BATCH_SIZE ids per HTTP call."""
+    msgs: Dict[str, Dict[str, Any]] = {}
+    failed = set()
+
+    @gmail_retry
+    def run(chunk: List[str]):
+        # Each attempt only re-requests the ids that haven't succeeded or failed for good
+        retryable = []
+
+        def cb(request_id, response, exception):
+            if exception is None:
+                msgs[request_id] = response
+            elif _is_retryable(exception):
+                retryable.append(exception)
+            else:
+                failed.add(request_id)
+                print(f"ERR {request_id}: {exception}")
+
+        batch = service.new_batch_http_request(callback=cb)
+        for mid in chunk:
+            if mid not in msgs and mid not in failed:
+                batch.add(service.users().messages().get(userId="me", id=mid, **get_kwargs), request_id=mid)
+        batch.execute()
+        if retryable:
+            raise retryable[0]
 
-def fetch_message(service, msg_id: str) -> Dict[str, Any]:
-    return service.users().messages().get(userId="me", id=msg_id, format="full").execute()
+    for i in range(0, len(ids), BATCH_SIZE):
+        chunk = ids[i:i + BATCH_SIZE]
+        try:
+            run(chunk)
+        except HttpError as e:
+            for mid in chunk:
+                if mid not in msgs and mid not in failed:
+                    print(f"ERR {mid}: {e}")
+    return msgs
+
+def fetch_metadata(service, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    return fetch_messages_batch(
+        service, ids, format="metadata", metadataHeaders=METADATA_HEADERS, fields="id,snippet,payload/headers"
+    )
+
+def fetch_full(service, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    return fetch_messages_batch(
+        service, ids, format="full", fields="id,snippet,payload(headers,parts,body,mimeType)"
+    )
 
 def headers_map(msg) -> Dict[str, str]:
     headers = {}
@@ -99,13 +327,19 @@ def headers_map(msg) -> Dict[str, str]:
         headers[h["name"].lower()] = h["value"]
     return headers
 
+def has_enough_metadata(msg) -> bool:
+    # A full snippet plus the subject is usually enough to triage without downloading the body.
+    # Recipient lists are left out: they are long for mailing lists but say nothing about content
+    subject = headers_map(msg).get("subject", "")
+    return len(msg.get("snippet", "")) + len(subject) >= METADATA_MIN_CHARS
+
 def summarize_for_llm(msg) -> Dict[str, Any]:
     hdrs = headers_map(msg)
     subject = hdrs.get("subject", "")
     from_ = hdrs.get("from", "")
     to = hdrs.get("to", "")
     cc = hdrs.get("cc", "")
-    body = _collect_text(msg["payload"])[:BODY_CHAR_LIMIT]
+    body = "" if has_enough_metadata(msg) else _collect_text(msg["payload"])[:BODY_CHAR_LIMIT]
     snippet = msg.get("snippet", "")
     return {
         "subject": subject, "from": from_, "to": to, "cc": cc,
@@ -116,22 +350,28 @@ def groq_client():
     api_key = os.getenv("GROQ_API_KEY")
     if not api_key:
         raise RuntimeError("GROQ_API_KEY env var not set")
-    return Groq(api_key=api_key)
+    return AsyncGroq(api_key=api_key)
 
 CLASSIFY_PROMPT_SYS = """You are an aggressive spam filter and email organizer. Your goal is to keep the inbox clean.
 
-Return ONLY valid JSON matching this schema:
+You will receive a JSON object {"emails": [...]}, where each email has an "id" plus its subject, sender, recipients, snippet and body.
+Classify every email independently and return ONLY valid JSON matching this schema, with one result per input email:
 {
-  "is_spam": true|false,
-  "is_important": true|false,
-  "confidence": 0.0-1.0,
-  "reason": "brief explanation",
-  "actions": {
-    "mark_spam": true|false,
-    "star": true|false,
-    "archive": true|false,
-    "mark_read": true|false
-  }
+  "results": [
+    {
+      "id": "the input email's id, copied verbatim",
+      "is_spam": true|false,
+      "is_important": true|false,
+      "confidence": 0.0-1.0,
+      "reason": "brief explanation",
+      "actions": {
+        "mark_spam": true|false,
+        "star": true|false,
+        "archive": true|false,
+        "mark_read": true|false
+      }
+    }
+  ]
 }
 
 SPAM DETECTION RULES (mark as spam if ANY of these apply):
@@ -158,37 +398,168 @@ DEFAULT ACTIONS:
 
 Be aggressive about spam detection. If fields contain random characters or nonsensical data, it's spam."""
 
-def classify_email_groq(client: Groq, payload: Dict[str, Any]) -> Dict[str, Any]:
+# Built once at import so each request reuses it instead of allocating a new system message dict
+_SYS_MSG = {"role": "system", "content": CLASSIFY_PROMPT_SYS}
+
+def _fallback_decision() -> Dict[str, Any]:
+    return {
+        "is_spam": False,
+        "is_important": False,
+        "confidence": 0.5,
+        "reason": "Failed to classify",
+        "actions": {
+            "mark_spam": False,
+            "star": False,
+            "archive": False,
+            "mark_read": False
+        }
+    }
+
+Record = Callable[[str, Dict[str, Any]], None]
+Flush = Callable[[], Awaitable[None]]
+
+class ResultStream:
+    """Incremental JSON scanner yielding each object of the "results" array as soon as it closes."""
+
+    def __init__(self):
+        self._buf = ""
+        self._pos = 0
+        self._stack: List[str] = []
+        self._in_str = False
+        self._esc = False
+        self._start = -1
+
+    def _in_results(self) -> bool:
+        # Directly inside {"results": [...]} (or a bare top-level array)
+        return bool(self._stack) and self._stack[-1] == "[" and len(self._stack) <= 2
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        self._buf += text
+        out = []
+        for i in range(self._pos, len(self._buf)):
+            c = self._buf[i]
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif c == "\\":
+                    self._esc = True
+                elif c == '"':
+                    self._in_str = False
+            elif c == '"':
+                self._in_str = True
+            elif c in "{[":
+                if c == "{" and self._in_results():
+                    self._start = i
+                self._stack.append(c)
+            elif c in "}]" and self._stack:
+                self._stack.pop()
+                if c == "}" and self._start >= 0 and self._in_results():
+                    try:
+                        out.append(json_loads(self._buf[self._start:i + 1]))
+                    except ValueError:
+                        pass  # left missing, so the email is retried on its own
+                    self._start = -1
+        self._pos = len(self._buf)
+        return out
+
+async def classify_emails_groq(client: AsyncGroq, batch: List[Tuple[str, Dict[str, Any]]], on_decision: Record):
+    """Classify several (message id, payload) pairs in one streamed Groq request.
+
+    Each decision is passed to on_decision as soon as its JSON object has streamed in.
+    """
     messages = [
-        {"role": "system", "content": CLASSIFY_PROMPT_SYS},
-        {"role": "user", "content": json.dumps(payload)}
+        _SYS_MSG,
+        {"role": "user", "content": json_dumps({"emails": [{"id": mid, **payload} for mid, payload in batch]})}
     ]
-    comp = client.chat.completions.create(
+    # JSON mode can't be combined with streaming; the prompt already demands JSON only
+    stream = await client.chat.completions.create(
         model=GROQ_MODEL,
         messages=messages,
         temperature=0,
-        response_format={"type": "json_object"},
+        stream=True,
     )
-    txt = comp.choices[0].message.content
-    try:
-        data = json.loads(txt)
-    except Exception as e:
-        print(f"Failed to parse LLM response: {e}")
-        data = {
+    pending = {mid for mid, _ in batch}
+    parser = ResultStream()
+    async for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if not delta:
+            continue
+        for r in parser.feed(delta):
+            mid = str(r.get("id"))
+            # Output isn't format-enforced; malformed results stay pending for the retry/fallback
+            if mid in pending and isinstance(r.get("actions"), dict):
+                pending.discard(mid)
+                on_decision(mid, r)
+
+    missing = [(mid, payload) for mid, payload in batch if mid in pending]
+    if missing and len(batch) > 1:
+        # Retry whatever the batched response lost, one email per request
+        # Retries are independent; one failing must not abandon the others still in flight
+        results = await asyncio.gather(
+            *(classify_emails_groq(client, [item], on_decision) for item in missing), return_exceptions=True
+        )
+        for (mid, _), res in zip(missing, results):
+            if isinstance(res, Exception):
+                print(f"ERR {mid}: {res}")
+    elif missing:
+        print(f"Failed to parse LLM response for {missing[0][0]}")
+        on_decision(missing[0][0], _fallback_decision())
+
+# URLs and addresses are stripped first; "https", hostnames and tracking ids look random
+_URL_OR_EMAIL = re.compile(r"(?:https?://|www\.)\S+|\S+@\S+", re.I)
+_WORD = re.compile(r"\b[A-Za-z]{6,}\b")
+# Vowel-free runs (y counts as a vowel, so "rhythm" and "crypts" pass)
+_NO_VOWELS = re.compile(r"^[bcdfghjklmnpqrstvwxz]+$", re.I)
+
+def _looks_random(word: str) -> bool:
+    # All-caps tokens are booking references, order and promo codes, not bot gibberish
+    if word.isupper():
+        return False
+    # Bot-filled form fields look like "EdMdbjVoiclGswk"/"ypAYYcUGutD": case flips mid-word
+    # far more often than in camel-cased names like "JavaScript" or "PowerPoint"
+    if len(word) >= 8 and sum(a.isupper() != b.isupper() for a, b in zip(word, word[1:])) >= 5:
+        return True
+    return bool(_NO_VOWELS.match(word))
+
+def _gibberish_count(text: str) -> int:
+    return sum(_looks_random(w) for w in _WORD.findall(_URL_OR_EMAIL.sub(" ", text)))
+
+def load_filters(path: str = FILTERS_FILE) -> Dict[str, Set[str]]:
+    """Load sender-domain allow/deny lists, e.g. {"allow_domains": [...], "deny_domains": [...]}."""
+    filters = {"allow_domains": set(), "deny_domains": set()}
+    if os.path.exists(path):
+        with open(path) as f:
+            data = json.load(f)
+        for key in filters:
+            filters[key] = {d.lower() for d in data.get(key, [])}
+    return filters
+
+def pre_classify(payload: Dict[str, Any], filters: Dict[str, Set[str]]) -> Optional[Dict[str, Any]]:
+    """Decide obvious spam/ham locally; returns None when the email needs the LLM."""
+    domain = parseaddr(payload["from"])[1].rpartition("@")[2].lower()
+    if domain in filters["allow_domains"]:
+        return {
             "is_spam": False,
-            "is_important": False,
-            "confidence": 0.5,
-            "reason": "Failed to classify",
-            "actions": {
-                "mark_spam": False,
-                "star": False,
-                "archive": False,
-                "mark_read": False
-            }
+            "is_important": True,
+            "confidence": 1.0,
+            "reason": f"Allowlisted sender domain {domain}",
+            "actions": {"mark_spam": False, "star": True, "archive": False, "mark_read": False},
         }
-    return data
+    if domain in filters["deny_domains"]:
+        reason = f"Denylisted sender domain {domain}"
+    elif _gibberish_count(payload["subject"] + " " + payload["snippet"]) >= 2:
+        reason = "Gibberish text in subject/snippet"
+    else:
+        return None
+    return {
+        "is_spam": True,
+        "is_important": False,
+        "confidence": 1.0,
+        "reason": reason,
+        "actions": {"mark_spam": True, "star": False, "archive": False, "mark_read": True},
+    }
 
-def apply_actions(service, msg_id: str, decision: Dict[str, Any], label_ids: Dict[str, str]):
+def plan_actions(decision: Dict[str, Any], label_ids: Dict[str, str]) -> Tuple[FrozenSet[str], FrozenSet[str]]:
     add, rem = [], []
 
     # Handle spam
@@ -213,11 +584,163 @@ def apply_actions(service, msg_id: str, decision: Dict[str, Any], label_ids: Dic
     # Always mark as processed
     add.append(label_ids["processed"])
 
-    # Apply changes
-    body = {"addLabelIds": list(set(add)), "removeLabelIds": list(set(rem))}
-    service.users().messages().modify(userId="me", id=msg_id, body=body).execute()
+    return frozenset(add), frozenset(rem)
+
+@gmail_retry
+def batch_modify(service, body: Dict[str, Any]):
+    service.users().messages().batchModify(userId="me", body=body).execute()
+
+def apply_actions_batch(service, buckets: Dict[Tuple[FrozenSet[str], FrozenSet[str]], List[str]]) -> List[str]:
+    """Issue one batchModify per distinct (add, remove) label combination; returns the ids modified."""
+    done: List[str] = []
+    for (add, rem), ids in buckets.items():
+        for i in range(0, len(ids), MODIFY_BATCH_SIZE):
+            chunk = ids[i:i + MODIFY_BATCH_SIZE]
+            body = {"ids": chunk, "addLabelIds": list(add), "removeLabelIds": list(rem)}
+            try:
+                batch_modify(service, body)
+                done.extend(chunk)
+            except Exception as e:
+                print(f"ERR batchModify ({len(chunk)} emails): {e}")
+                if isinstance(e, HttpError) and e.resp.status in (400, 404) and "label" in str(e).lower():
+                    # AI/* label deleted or recreated; re-list labels on the next run
+                    _LABEL_CACHE.clear()
+    return done
+
+def record_stats(stats: Dict[str, int], decision: Dict[str, Any]) -> str:
+    if decision["actions"].get("mark_spam"):
+        stats["spam"] += 1
+        return "SPAM"
+    if decision.get("is_important"):
+        stats["important"] += 1
+        return "IMPORTANT"
+    if decision["actions"].get("archive"):
+        stats["archived"] += 1
+        return "ARCHIVED"
+    stats["kept"] += 1
+    return "KEPT"
+
+async def fetch_stage(service, ids: List[str], queue: asyncio.Queue, record: Record, gmail_lock: asyncio.Lock, flush: Flush):
+    """Fetch messages chunk by chunk, decide obvious ones locally, and queue the rest for Groq."""
+    filters = load_filters()
+    try:
+        for i in range(0, len(ids), BATCH_SIZE):
+            chunk = ids[i:i + BATCH_SIZE]
+            # googleapiclient is blocking; run it off the event loop, one call at a time
+            try:
+                async with gmail_lock:
+                    msgs = await asyncio.to_thread(fetch_metadata, service, chunk)
+                need_body = [mid for mid, msg in msgs.items() if not has_enough_metadata(msg)]
+                if need_body:
+                    async with gmail_lock:
+                        full = await asyncio.to_thread(fetch_full, service, need_body)
+                    for mid in need_body:
+                        # Don't classify from metadata alone; the fetch error is already logged
+                        if mid in full:
+                            msgs[mid] = full[mid]
+                        else:
+                            del msgs[mid]
+            except Exception as e:
+                for mid in chunk:
+                    print(f"ERR {mid}: {e}")
+                continue
+            for mid, msg in msgs.items():
+                try:
+                    payload = summarize_for_llm(msg)
+                    decision = pre_classify(payload, filters)
+                    if decision is None:
+                        await queue.put((mid, payload))
+                    else:
+                        record(mid, decision)
+                except Exception as e:
+                    print(f"ERR {mid}: {e}")
+            await flush()  # apply the locally decided ones without waiting for Groq
+    finally:
+        await queue.put(None)
+
+async def classify_stage(client: AsyncGroq, queue: asyncio.Queue, record: Record, flush: Flush):
+    """Group queued payloads into Groq batches of up to LLM_BATCH_SIZE or LLM_MAX_WAIT seconds."""
+    sem = asyncio.Semaphore(GROQ_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+
+    async def run(batch: List[Tuple[str, Dict[str, Any]]]):
+        handled = set()
+
+        def on_decision(mid: str, decision: Dict[str, Any]):
+            handled.add(mid)
+            try:
+                record(mid, decision)
+            except Exception as e:
+                print(f"ERR {mid}: {e}")
+
+        async with sem:
+            try:
+                await classify_emails_groq(client, batch, on_decision)
+            except Exception as e:
+                for mid, _ in batch:
+                    if mid not in handled:
+                        print(f"ERR {mid}: {e}")
+        await flush()
+
+    tasks = []
+    finished = False
+    while not finished:
+        item = await queue.get()
+        if item is None:
+            break
+        batch = [item]
+        deadline = loop.time() + LLM_MAX_WAIT
+        while len(batch) < LLM_BATCH_SIZE:
+            try:
+                item = await asyncio.wait_for(queue.get(), max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                finished = True
+                break
+            batch.append(item)
+        tasks.append(asyncio.create_task(run(batch)))
+    await asyncio.gather(*tasks)
+
+async def classify_pipeline(service, ids: List[str], label_ids: Dict[str, str], stats: Dict[str, int]) -> List[str]:
+    """Fetch, classify and label ids; returns the ids whose label changes were applied.
+
+    Groq calls start on the first fetched chunk while later chunks are still downloading, and
+    label changes are flushed through batchModify as each Groq batch finishes.
+    """
+    # The client is created here, only when there is mail, and always closed
+    client = groq_client()
+    # googleapiclient's shared httplib2 connection isn't thread-safe; one Gmail call at a time
+    gmail_lock = asyncio.Lock()
+    buckets: Dict[Tuple[FrozenSet[str], FrozenSet[str]], List[str]] = {}
+    done: List[str] = []
+
+    def record(mid: str, decision: Dict[str, Any]):
+        buckets.setdefault(plan_actions(decision, label_ids), []).append(mid)
+        status = record_stats(stats, decision)
+        print(f"OK {mid} -> {status} (confidence: {decision.get('confidence', 0):.1f}) - {decision.get('reason', '')}")
+
+    async def flush():
+        if not buckets:
+            return
+        pending = dict(buckets)
+        buckets.clear()
+        async with gmail_lock:
+            done.extend(await asyncio.to_thread(apply_actions_batch, service, pending))
 
-def main():
+    queue: asyncio.Queue = asyncio.Queue()
+    try:
+        await asyncio.gather(
+            fetch_stage(service, ids, queue, record, gmail_lock, flush),
+            classify_stage(client, queue, record, flush),
+        )
+    finally:
+        await client.close()
+        await flush()
+    return done
+
+def main(new_ids: Optional[List[str]] = None):
+    """Process unprocessed inbox mail, or just new_ids when given (from a push notification)."""
     service = gmail_client()
     # Simplified label system - only 2 custom labels
     label_ids = {
@@ -225,48 +748,36 @@ def main():
         "important": ensure_label(service, AI_IMPORTANT_LABEL),
     }
     
-    client = groq_client()
-    ids = get_unprocessed_message_ids(service, label_ids["processed"])
+    conn = state_db()
+    started = int(time.time())
+    if new_ids is None:
+        ids, complete = get_unprocessed_message_ids(service, conn)
+    else:
+        # Push-driven runs only see a slice of the window, so they never advance the poll mark
+        ids, complete = filter_unseen(conn, new_ids), False
     if not ids:
+        if complete:
+            mark_polled(conn, started)
         print("No new messages to process.")
         return
 
     print(f"Processing {len(ids)} emails...")
     stats = {"spam": 0, "important": 0, "archived": 0, "kept": 0}
-    
-    for mid in ids:
-        try:
-            msg = fetch_message(service, mid)
-            payload = summarize_for_llm(msg)
-            decision = classify_email_groq(client, payload)
-            apply_actions(service, mid, decision, label_ids)
-            
-            # Update statistics
-            if decision["actions"].get("mark_spam"):
-                stats["spam"] += 1
-                status = "SPAM"
-            elif decision.get("is_important"):
-                stats["important"] += 1
-                status = "IMPORTANT"
-            elif decision["actions"].get("archive"):
-                stats["archived"] += 1
-                status = "ARCHIVED"
-            else:
-                stats["kept"] += 1
-                status = "KEPT"
-            
-            print(f"OK {mid} -> {status} (confidence: {decision.get('confidence', 0):.1f}) - {decision.get('reason', '')}")
-            time.sleep(0.2)  # gentle pacing
-        except Exception as e:
-            print(f"ERR {mid}: {e}")
+    done = asyncio.run(classify_pipeline(service, ids, label_ids, stats))
+    mark_seen(conn, done)
+    # Narrow the next query only once nothing in this window is left to retry
+    if complete and len(done) == len(ids):
+        mark_polled(conn, started)
     
     # Print summary
     print(f"\n=== Summary ===")
     print(f"Spam: {stats['spam']}, Important: {stats['important']}, Archived: {stats['archived']}, Kept in inbox: {stats['kept']}")
 
+# Set by the HTTP server when Gmail pushes a change; Gmail work itself stays on the main thread
+_PUSH_EVENT = threading.Event()
+
 def run_health_server():
-    """Run a simple HTTP server for health checks (required by Render Web Services)."""
-    import threading
+    """Run a simple HTTP server for health checks (required by Render Web Services) and Gmail push."""
     from http.server import HTTPServer, BaseHTTPRequestHandler
     
     class HealthHandler(BaseHTTPRequestHandler):
@@ -282,6 +793,27 @@ def run_health_server():
                 self.end_headers()
                 self.wfile.write(b'<h1>Gmail Groq Worker</h1><p>Service is running. <a href="/health">Health Check</a></p>')
         
+        def do_POST(self):
+            path, _, query = self.path.partition("?")
+            if path != PUSH_PATH:
+                self.send_response(404)
+                self.end_headers()
+                return
+            if PUBSUB_TOKEN and f"token={PUBSUB_TOKEN}" not in query.split("&"):
+                self.send_response(403)
+                self.end_headers()
+                return
+            envelope = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                data = json_loads(_decode_part(json_loads(envelope)["message"]["data"]))
+                print(f"Push received (historyId {data.get('historyId')})")
+            except Exception as e:
+                print(f"Malformed push notification: {e}")
+            # Always wake the worker; the history query works out what actually changed
+            _PUSH_EVENT.set()
+            self.send_response(204)
+            self.end_headers()
+
         def log_message(self, format, *args):
             # Suppress HTTP server logs to keep output clean
             pass
@@ -291,12 +823,65 @@ def run_health_server():
     print(f"Health server running on port {port}")
     server.serve_forever()
 
+def run_push_loop(topic: str):
+    """Process mail as Gmail push notifications arrive, with an hourly safety-net poll.
+
+    If the watch can't be registered (bad topic, missing Publisher grant), the worker keeps
+    polling and retries the watch with exponential backoff.
+    """
+    history_id = None
+    renew_at = 0.0
+    retry_delay = WATCH_RETRY_SECS
+    while True:
+        try:
+            service = gmail_client()
+            if time.time() >= renew_at:
+                try:
+                    watched = start_watch(service, topic)
+                except Exception as e:
+                    print(f"Gmail watch failed: {e}")
+                    print(f"Polling instead; retrying the watch in {retry_delay}s...")
+                    renew_at = time.time() + retry_delay
+                    retry_delay = min(retry_delay * 2, PUSH_FALLBACK_POLL_SECS)
+                    main()
+                else:
+                    renew_at = time.time() + WATCH_RENEW_SECS
+                    retry_delay = WATCH_RETRY_SECS
+                    if history_id is None:
+                        history_id = watched
+                        main()  # catch up on anything that arrived before the watch started
+            # Wake for a push, the next watch attempt, or the hourly safety net, whichever is first
+            timeout = min(PUSH_FALLBACK_POLL_SECS, max(0.0, renew_at - time.time()))
+            if _PUSH_EVENT.wait(timeout):
+                _PUSH_EVENT.clear()
+                ids = None
+                if history_id is not None:
+                    ids, history_id = get_history_message_ids(service, history_id)
+                if ids is None:
+                    print("No usable history, running a full poll...")
+                    main()
+                elif ids:
+                    main(ids)
+            elif time.time() < renew_at:
+                print("No push in the last hour, running safety-net poll...")
+                main()
+        except KeyboardInterrupt:
+            print("\nStopping push mode...")
+            break
+        except Exception as e:
+            print(f"Error in push mode: {e}")
+            time.sleep(60)
+
 if __name__ == "__main__":
     import sys
-    import threading
     
     # Check if we should run once or continuously
-    if len(sys.argv) > 1 and sys.argv[1] == "--continuous":
+    if len(sys.argv) > 1 and sys.argv[1] == "--continuous" and PUBSUB_TOPIC:
+        print(f"Running in push mode (topic {PUBSUB_TOPIC})...")
+        # The HTTP server receives the Pub/Sub push requests
+        threading.Thread(target=run_health_server, daemon=True).start()
+        run_push_loop(PUBSUB_TOPIC)
+    elif len(sys.argv) > 1 and sys.argv[1] == "--continuous":
         print("Running in continuous mode (every 10 minutes)...")
         
         # Start health server in background thread (for Render Web Service)
@@ -0,0 +1,49 @@
+from gmail_groq_worker import pre_classify
+
+NO_FILTERS = {"allow_domains": set(), "deny_domains": set()}
+
+
+def payload(subject="", snippet="", from_="Someone <someone@example.com>"):
+    return {"subject": subject, "from": from_, "to": "", "cc": "", "snippet": snippet, "body": ""}
+
+
+def test_url_heavy_snippet_goes_to_llm():
+    p = payload(
+        subject="Re: [org/repo] Fix flaky test (PR #123)",
+        snippet="merged this. See https://github.com/org/repo/pull/123 and "
+        "https://github.com/org/repo/actions/runs/98765 HTTPS://EXAMPLE.COM/xyzzy",
+        from_="GitHub <notifications@github.com>",
+    )
+    assert pre_classify(p, NO_FILTERS) is None
+
+
+def test_email_addresses_and_ordinary_words_go_to_llm():
+    p = payload(subject="Rhythm section", snippet="Contact bcdfgh@xkcdbrt.com about crypts and rhythms")
+    assert pre_classify(p, NO_FILTERS) is None
+
+
+def test_camel_case_names_go_to_llm():
+    p = payload(subject="JavaScript and PowerPoint tips", snippet="LinkedIn YouTube McDonalds")
+    assert pre_classify(p, NO_FILTERS) is None
+
+
+def test_all_caps_codes_go_to_llm():
+    p = payload(subject="Invoice", snippet="Ref QWRTPLKJ and BCDFGHJK, promo code XKCDBRTZ")
+    assert pre_classify(p, NO_FILTERS) is None
+
+
+def test_bot_form_gibberish_is_spam():
+    p = payload(subject="New Quote Request", snippet="Name: EdMdbjVoiclGswk Address: ypAYYcUGutD")
+    decision = pre_classify(p, NO_FILTERS)
+    assert decision is not None and decision["actions"]["mark_spam"]
+
+
+def test_lowercase_vowel_free_strings_are_spam():
+    p = payload(subject="Contact Form Submission", snippet="Name: xkcdbrt City: qwrtplm")
+    assert pre_classify(p, NO_FILTERS)["is_spam"]
+
+
+def test_sender_domain_filters():
+    filters = {"allow_domains": {"family.org"}, "deny_domains": {"spam.biz"}}
+    assert pre_classify(payload(from_="Mom <mom@family.org>"), filters)["is_important"]
+    assert pre_classify(payload(from_="Deals <x@spam.biz>"), filters)["is_spam"]
@@ -0,0 +1,50 @@
+import json
+
+from gmail_groq_worker import ResultStream
+
+RESULTS = [
+    {"id": "a", "is_spam": False, "reason": 'quote " brace } bracket ] backslash \\', "actions": {"archive": True}},
+    {"id": "b", "is_spam": True, "reason": "nested {\"x\": [1]}", "actions": {"mark_spam": True, "star": False}},
+]
+
+
+def feed_in_chunks(text, size):
+    stream, out = ResultStream(), []
+    for i in range(0, len(text), size):
+        out.extend(stream.feed(text[i:i + size]))
+    return out
+
+
+def test_yields_each_result_as_it_closes():
+    stream = ResultStream()
+    text = json.dumps({"results": RESULTS})
+    first_end = text.index('"id": "b"')
+    assert stream.feed(text[:first_end]) == [RESULTS[0]]
+    assert stream.feed(text[first_end:]) == [RESULTS[1]]
+
+
+def test_chunk_splits_inside_strings_and_escapes():
+    text = json.dumps({"results": RESULTS})
+    for size in (1, 2, 3, 7):
+        assert feed_in_chunks(text, size) == RESULTS
+
+
+def test_nested_actions_objects_are_not_yielded_separately():
+    out = feed_in_chunks(json.dumps({"results": RESULTS}, indent=2), 5)
+    assert [r["id"] for r in out] == ["a", "b"]
+    assert out[1]["actions"] == {"mark_spam": True, "star": False}
+
+
+def test_ignores_text_around_code_fences():
+    text = "Here you go:\n```json\n" + json.dumps({"results": RESULTS}) + "\n```\nDone {not json}"
+    assert feed_in_chunks(text, 4) == RESULTS
+
+
+def test_bare_top_level_array():
+    assert feed_in_chunks(json.dumps(RESULTS), 6) == RESULTS
+
+
+def test_truncated_stream_yields_only_complete_results():
+    text = json.dumps({"results": RESULTS})
+    cut = text.index('"actions": {"mark_spam"')
+    assert feed_in_chunks(text[:cut], 3) == [RESULTS[0]]